@@ -0,0 +1,220 @@
+import json
+import mmap
+import os
+import pickle
+import numpy as np
+from typing import List, Dict, Any, Optional
+from logging_config import logger
+
+# One row per chunk; the chunk text lives in chunks.bin at [offset, offset + length)
+ROW_DTYPE = np.dtype([
+    ("meta_id", np.int32),
+    ("chunk_index", np.int32),
+    ("offset", np.int64),
+    ("length", np.int32),
+])
+
+def fsync_path(path: str):
+    """Flush a file, or a directory's entries (e.g. after os.replace), to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class DocumentStore:
+    """
+    Column-oriented storage for a user's chunks.
+
+    Chunk text is kept in an append-only, memory-mapped chunks.bin; rows.npy holds a
+    structured array of (meta_id, chunk_index, offset, length) per chunk, and meta.json
+    holds each upload's metadata once instead of once per chunk. Documents are only
+    materialized as dicts for the rows a caller actually reads.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # Row buffer grown by doubling; only the first _count rows are in use
+        self._rows = np.empty(0, dtype=ROW_DTYPE)
+        self._count = 0
+        self._metadata: List[Dict[str, Any]] = []
+        # Bytes of chunks.bin referenced by saved rows, and chunk bytes added since the last save.
+        # Anything in chunks.bin past _persisted_size is stale and overwritten by the next save
+        self._persisted_size = 0
+        self._pending = bytearray()
+        self._mm: Optional[mmap.mmap] = None
+
+    @property
+    def _chunks_file(self) -> str:
+        return os.path.join(self.path, "chunks.bin")
+
+    @property
+    def _rows_file(self) -> str:
+        return os.path.join(self.path, "rows.npy")
+
+    @property
+    def _meta_file(self) -> str:
+        return os.path.join(self.path, "meta.json")
+
+    @classmethod
+    def exists(cls, path: str) -> bool:
+        """Return True if a saved store (or a legacy documents.pkl) is present at path."""
+        return os.path.exists(os.path.join(path, "rows.npy")) or os.path.exists(os.path.join(path, "documents.pkl"))
+
+    @classmethod
+    def load(cls, path: str) -> "DocumentStore":
+        """Load a saved store, migrating a legacy documents.pkl if that is all there is."""
+        store = cls(path)
+        if not os.path.exists(store._rows_file):
+            legacy_file = os.path.join(path, "documents.pkl")
+            with open(legacy_file, "rb") as f:
+                documents = pickle.load(f)
+            store._import_documents(documents)
+            store.save()
+            os.remove(legacy_file)
+            logger.info(f"Migrated {len(documents)} documents in {path} from documents.pkl")
+            return store
+
+        store._rows = np.load(store._rows_file)
+        store._count = len(store._rows)
+        with open(store._meta_file, "r", encoding="utf-8") as f:
+            store._metadata = json.load(f)
+
+        # chunks.bin may hold bytes written after rows.npy was last saved; those chunks are
+        # replayed from the write-ahead log and the bytes are overwritten by the next save
+        store._persisted_size = int(store._rows["offset"][-1] + store._rows["length"][-1]) if store._count else 0
+        store._remap()
+        return store
+
+    def _import_documents(self, documents: List[Dict[str, Any]]):
+        """Build rows from the legacy list-of-dicts layout, sharing metadata between chunks of one upload."""
+        meta_ids = {}
+        for doc in documents:
+            metadata = doc["metadata"]
+            # Chunks of one upload share the same metadata object in the legacy pickle
+            if id(metadata) not in meta_ids:
+                meta_ids[id(metadata)] = len(self._metadata)
+                self._metadata.append(metadata)
+            self._append_rows([doc["chunk"]], meta_ids[id(metadata)], [doc["chunk_index"]])
+
+    def _remap(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._persisted_size:
+            with open(self._chunks_file, "rb") as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _reserve(self, count: int):
+        """Grow the row buffer to hold at least count rows, doubling its capacity to amortize copies."""
+        if count <= len(self._rows):
+            return
+        rows = np.empty(max(count, 2 * len(self._rows), 1024), dtype=ROW_DTYPE)
+        rows[:self._count] = self._rows[:self._count]
+        self._rows = rows
+
+    def _append_rows(self, chunks: List[str], meta_id: int, chunk_indices: List[int]):
+        encoded = [chunk.encode("utf-8") for chunk in chunks]
+        self._reserve(self._count + len(encoded))
+        rows = self._rows[self._count:self._count + len(encoded)]
+        rows["meta_id"] = meta_id
+        rows["chunk_index"] = chunk_indices
+        rows["length"] = [len(data) for data in encoded]
+        start = self._persisted_size + len(self._pending)
+        rows["offset"] = start + np.concatenate(([0], np.cumsum(rows["length"][:-1], dtype=np.int64)))
+        for data in encoded:
+            self._pending += data
+        self._count += len(encoded)
+
+    def extend(self, chunks: List[str], metadata: Dict[str, Any]):
+        """Add the chunks of one upload; metadata is stored once for all of them."""
+        if not chunks:
+            return
+        meta_id = len(self._metadata)
+        self._metadata.append(metadata)
+        self._append_rows(chunks, meta_id, list(range(len(chunks))))
+
+    def _read(self, offset: int, length: int) -> bytes:
+        if offset >= self._persisted_size:
+            start = offset - self._persisted_size
+            return bytes(self._pending[start:start + length])
+        return self._mm[offset:offset + length]
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        if not 0 <= idx < self._count:
+            raise IndexError(f"Document {idx} out of range")
+        meta_id, chunk_index, offset, length = self._rows[idx].tolist()
+        return {
+            "chunk": self._read(offset, length).decode("utf-8"),
+            "metadata": self._metadata[meta_id],
+            "chunk_index": chunk_index,
+            "doc_id": int(idx)
+        }
+
+    def save(self):
+        """Flush pending chunk bytes to chunks.bin and atomically replace rows.npy and meta.json."""
+        os.makedirs(self.path, exist_ok=True)
+        if self._pending:
+            # Release the mapping before resizing the file; some platforms refuse to resize mapped files
+            self.close()
+            # Write right after the saved rows' bytes rather than at the end of the file, which may
+            # hold stale bytes from an unsaved upload or from a store that failed to load
+            fd = os.open(self._chunks_file, os.O_RDWR | os.O_CREAT, 0o644)
+            with os.fdopen(fd, "r+b") as f:
+                f.seek(self._persisted_size)
+                f.write(self._pending)
+                f.truncate()
+                f.flush()
+                os.fsync(f.fileno())
+            self._persisted_size += len(self._pending)
+            self._pending = bytearray()
+
+        # The temporary files are synced before they replace the old ones, and the directory after,
+        # so a crash can't leave renamed files whose contents never reached the disk
+        with open(self._rows_file + ".tmp", "wb") as f:
+            np.save(f, self._rows[:self._count])
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self._meta_file + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self._metadata, f, default=str)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self._rows_file + ".tmp", self._rows_file)
+        os.replace(self._meta_file + ".tmp", self._meta_file)
+        fsync_path(self.path)
+        self._remap()
+
+    def truncate(self, count: int):
+        """Drop every chunk from index count onwards, and the metadata only those chunks used."""
+        if count >= self._count:
+            return
+        self._count = count
+        end = int(self._rows["offset"][count - 1] + self._rows["length"][count - 1]) if count else 0
+        if end < self._persisted_size:
+            # The dropped bytes of chunks.bin are overwritten by the next save
+            self._persisted_size = end
+            self._pending = bytearray()
+        else:
+            del self._pending[end - self._persisted_size:]
+        self._metadata = self._metadata[:int(self._rows["meta_id"][count - 1]) + 1] if count else []
+
+    def clear(self):
+        """Drop every chunk, removing chunks.bin and the saved rows and metadata."""
+        self.close()
+        self._rows = np.empty(0, dtype=ROW_DTYPE)
+        self._count = 0
+        self._metadata = []
+        self._persisted_size = 0
+        self._pending = bytearray()
+        for path in (self._chunks_file, self._rows_file, self._meta_file, os.path.join(self.path, "documents.pkl")):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def close(self):
+        """Release the memory map over chunks.bin."""
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
@@ -1,55 +1,245 @@
 import openai
-from typing import List, Dict, Any
+import asyncio
+import hashlib
+import httpx
+import json
+import numpy as np
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Iterator, Tuple
 from config import config
 from logging_config import logger
 
+# Errors worth retrying: rate limits, timeouts, dropped connections and 5xx responses
+_RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
 class EmbeddingService:
     def __init__(self):
-        openai.api_key = config.OPENAI_API_KEY
+        # The shared client reuses its pooled HTTP/2 connections; SDK retries are disabled
+        # because _aembed_batch applies its own backoff
+        limits = httpx.Limits(
+            max_connections=getattr(config, "OPENAI_MAX_CONNECTIONS", 64),
+            max_keepalive_connections=getattr(config, "OPENAI_MAX_KEEPALIVE_CONNECTIONS", 32)
+        )
+        self.aclient = openai.AsyncOpenAI(
+            api_key=config.OPENAI_API_KEY, timeout=60, max_retries=0,
+            http_client=httpx.AsyncClient(http2=True, limits=limits)
+        )
+        # LRU cache of embeddings keyed by sha256(model + text), stored compactly
+        # as float32, float16 or int8 (plus scale) per config.EMBED_CACHE_DTYPE
+        self._cache: "OrderedDict[bytes, Tuple[np.ndarray, float]]" = OrderedDict()
+        self._cache_max_entries = getattr(config, "EMBEDDING_CACHE_SIZE", 10_000)
+        self._cache_dtype = getattr(config, "EMBED_CACHE_DTYPE", "float16")
+        if self._cache_dtype not in ("float32", "float16", "int8"):
+            raise ValueError(f"Unsupported EMBED_CACHE_DTYPE: {self._cache_dtype}")
+        # Per-request limits for the embeddings endpoint. The API accepts up to 2048 inputs,
+        # but smaller batches let acreate_embeddings keep several requests in flight at once
+        self._batch_max_items = getattr(config, "EMBEDDING_BATCH_MAX_ITEMS", 512)
+        self._batch_max_chars = getattr(config, "EMBEDDING_BATCH_MAX_CHARS", 800_000)
+        self._max_retries = getattr(config, "EMBEDDING_MAX_RETRIES", 5)
+        self._concurrency = getattr(config, "EMBEDDING_CONCURRENCY", 8)
+        
+        self._chunk_size = config.CHUNK_SIZE
+        self._chunk_stride = config.CHUNK_SIZE - config.CHUNK_OVERLAP
+        if self._chunk_stride <= 0:
+            raise ValueError(f"CHUNK_OVERLAP ({config.CHUNK_OVERLAP}) must be smaller than CHUNK_SIZE ({config.CHUNK_SIZE})")
+    
+    def iter_chunks(self, text: str) -> Iterator[str]:
+        """
+        Lazily yield overlapping character chunks of text, skipping whitespace-only ones
+        """
+        chunk_size = self._chunk_size
+        for start in range(0, len(text), self._chunk_stride):
+            chunk = text[start:start + chunk_size]
+            if not chunk.isspace():
+                yield chunk
     
     def chunk_text(self, text: str) -> List[str]:
         """
         Simple text chunking by character count
         """
-        chunk_size = config.CHUNK_SIZE
-        overlap = config.CHUNK_OVERLAP
-        chunks = []
+        return list(self.iter_chunks(text))
+    
+    def _cache_key(self, text: str) -> bytes:
+        return hashlib.sha256((config.EMBEDDING_MODEL + "\0" + text).encode("utf-8")).digest()
+    
+    def _cache_get(self, key: bytes) -> Optional[np.ndarray]:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        self._cache.move_to_end(key)
         
-        for i in range(0, len(text), chunk_size - overlap):
-            chunk = text[i:i + chunk_size]
-            if chunk.strip():
-                chunks.append(chunk)
+        vector, scale = entry
+        if self._cache_dtype == "int8":
+            return vector.astype(np.float32) * np.float32(scale / 127)
+        return vector.astype(np.float32)
+    
+    def _cache_put(self, key: bytes, embedding: np.ndarray):
+        vector = np.asarray(embedding, dtype=np.float32)
+        if self._cache_dtype == "int8":
+            # Symmetric per-vector quantization: the largest component maps to +/-127
+            scale = float(np.max(np.abs(vector))) or 1.0
+            self._cache[key] = (np.round(vector / scale * 127).astype(np.int8), scale)
+        else:
+            self._cache[key] = (vector.astype(self._cache_dtype), 1.0)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self._cache_max_entries:
+            self._cache.popitem(last=False)
+    
+    def _batched(self, texts: List[str]) -> Iterator[List[str]]:
+        """
+        Split texts into request-sized batches bounded by item count and total characters
+        """
+        batch, batch_chars = [], 0
+        for text in texts:
+            if batch and (len(batch) >= self._batch_max_items or batch_chars + len(text) > self._batch_max_chars):
+                yield batch
+                batch, batch_chars = [], 0
+            batch.append(text)
+            batch_chars += len(text)
+        if batch:
+            yield batch
+    
+    async def _aembed_batch(self, batch: List[str]) -> np.ndarray:
+        """
+        Embed a single batch, retrying with exponential backoff on transient errors
+        """
+        for attempt in range(self._max_retries + 1):
+            try:
+                response = await self.aclient.embeddings.create(
+                    model=config.EMBEDDING_MODEL,
+                    input=batch
+                )
+                return np.array([data.embedding for data in response.data], dtype=np.float32)
+            except _RETRYABLE_ERRORS as e:
+                if attempt == self._max_retries:
+                    raise
+                delay = 2 ** attempt
+                logger.warning("Embedding request failed (%s). Retrying in %ds (attempt %d/%d).", e, delay, attempt + 1, self._max_retries)
+                await asyncio.sleep(delay)
+    
+    def _lookup(self, texts: List[str]):
+        """
+        Resolve texts against the cache.
+        Returns a result list with hits filled in and the misses grouped by
+        cache key so identical chunks are only embedded once.
+        """
+        keys = [self._cache_key(text) for text in texts]
+        result: List[Optional[np.ndarray]] = [self._cache_get(key) for key in keys]
+        
+        misses: Dict[bytes, List[int]] = {}
+        for i, embedding in enumerate(result):
+            if embedding is None:
+                misses.setdefault(keys[i], []).append(i)
         
-        return chunks
+        logger.info("Creating embeddings for %d chunks (%d unique uncached).", len(texts), len(misses))
+        return result, misses
+    
+    def _fill(self, result: List[Optional[np.ndarray]], misses: Dict[bytes, List[int]], embeddings: List[np.ndarray]) -> np.ndarray:
+        """
+        Cache freshly created embeddings, fan them out to their original positions
+        and stack everything into one float32 matrix
+        """
+        for key, embedding in zip(misses, (row for batch in embeddings for row in batch)):
+            self._cache_put(key, embedding)
+            for i in misses[key]:
+                result[i] = embedding
+        logger.info("Embeddings created successfully.")
+        return np.vstack(result) if result else np.empty((0, 0), dtype=np.float32)
     
-    def create_embeddings(self, texts: List[str]) -> List[List[float]]:
+    async def acreate_embeddings(self, texts: List[str]) -> np.ndarray:
         """
-        Create embeddings using OpenAI's embedding model
+        Create embeddings using OpenAI's embedding model.
+        Previously embedded texts are served from the cache; only misses hit the API, in batches
+        sent concurrently, bounded by config.EMBEDDING_CONCURRENCY in-flight requests.
+        Returns a float32 matrix with one row per text.
         """
         try:
-            logger.info(f"Creating embeddings for {len(texts)} chunks.")
-            response = openai.embeddings.create(
-                model=config.EMBEDDING_MODEL,
-                input=texts
-            )
-            logger.info("Embeddings created successfully.")
-            return [data.embedding for data in response.data]
+            result, misses = self._lookup(texts)
+            semaphore = asyncio.Semaphore(self._concurrency)
+            
+            async def embed(batch: List[str]) -> np.ndarray:
+                async with semaphore:
+                    return await self._aembed_batch(batch)
+            
+            batches = self._batched([texts[indices[0]] for indices in misses.values()])
+            embeddings = await asyncio.gather(*(embed(batch) for batch in batches))
+            return self._fill(result, misses, embeddings)
         except Exception as e:
-            logger.error(f"Failed to create embeddings: {str(e)}", exc_info=True)
+            logger.error("Failed to create embeddings: %s", e, exc_info=True)
             raise Exception(f"Failed to create embeddings: {str(e)}")
     
-    def process_document(self, content: str, metadata: Dict[str, Any] = None) -> Dict[str, Any]:
+    async def submit_batch(self, chunks: List[str]) -> str:
+        """
+        Submit chunks to the OpenAI Batch API for offline embedding.
+        Returns the batch id; results are collected with fetch_batch_embeddings.
+        """
+        try:
+            lines = [
+                json.dumps({
+                    "custom_id": str(i),
+                    "method": "POST",
+                    "url": "/v1/embeddings",
+                    "body": {"model": config.EMBEDDING_MODEL, "input": chunk}
+                })
+                for i, chunk in enumerate(chunks)
+            ]
+            input_file = await self.aclient.files.create(
+                file=("embeddings.jsonl", "\n".join(lines).encode("utf-8")),
+                purpose="batch"
+            )
+            batch = await self.aclient.batches.create(
+                input_file_id=input_file.id,
+                endpoint="/v1/embeddings",
+                completion_window="24h"
+            )
+            logger.info("Submitted embedding batch %s with %d chunks.", batch.id, len(chunks))
+            return batch.id
+        except Exception as e:
+            logger.error("Failed to submit embedding batch: %s", e, exc_info=True)
+            raise Exception(f"Failed to submit embedding batch: {str(e)}")
+    
+    async def get_batch(self, batch_id: str):
+        """
+        Retrieve the current state of a Batch API job
+        """
+        return await self.aclient.batches.retrieve(batch_id)
+    
+    async def fetch_batch_embeddings(self, batch, chunks: List[str]) -> np.ndarray:
+        """
+        Download the output of a completed batch and return embeddings in chunk order
+        """
+        output = await self.aclient.files.content(batch.output_file_id)
+        embeddings: List[Optional[np.ndarray]] = [None] * len(chunks)
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            if record.get("error") or response.get("status_code") != 200:
+                raise Exception(f"Batch request {record.get('custom_id')} failed: {record.get('error') or response.get('body')}")
+            embeddings[int(record["custom_id"])] = np.array(response["body"]["data"][0]["embedding"], dtype=np.float32)
+        
+        missing = sum(1 for embedding in embeddings if embedding is None)
+        if missing:
+            raise Exception(f"Batch {batch.id} output is missing {missing} embeddings")
+        
+        for chunk, embedding in zip(chunks, embeddings):
+            self._cache_put(self._cache_key(chunk), embedding)
+        return np.vstack(embeddings)
+    
+    async def aprocess_document(self, content: str, metadata: Dict[str, Any] = None) -> Dict[str, Any]:
         """
         Process a document: chunk it and create embeddings
         """
         logger.info("Processing document...")
-        # Chunk the text
         chunks = self.chunk_text(content)
+        embeddings = await self.acreate_embeddings(chunks)
         
-        # Create embeddings for chunks
-        embeddings = self.create_embeddings(chunks)
-        
-        # Prepare document data
         processed_data = {
             "chunks": chunks,
             "embeddings": embeddings,
@@ -57,8 +247,14 @@ class EmbeddingService:
             "total_chunks": len(chunks)
         }
         
-        logger.info(f"Document processed. Total chunks: {len(chunks)}")
+        logger.info("Document processed. Total chunks: %d", len(chunks))
         return processed_data
 
+    async def aclose(self):
+        """
+        Close the pooled connections of the OpenAI client
+        """
+        await self.aclient.close()
+
 # Initialize embedding service
 embedding_service = EmbeddingService()
\ No newline at end of file
@@ -1,11 +1,67 @@
 import os
-from typing import Dict, Any, List
-from PyPDF2 import PdfReader
-import pandas as pd
-from docx import Document
+from typing import Dict, Any, List, Optional, Union
 import io
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from config import config
 from logging_config import logger
 
+# Shared by every upload so concurrent large PDFs queue for a bounded set of workers
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+_pdf_pool_lock = threading.Lock()
+_pdf_max_workers = getattr(config, "PDF_MAX_WORKERS", os.cpu_count() or 1)
+# pypdfium2 forbids concurrent calls even on different documents, and uploads are processed in
+# worker threads; every PDFium call made in this process holds this lock
+_pdfium_lock = threading.Lock()
+
+def _extract_pdfium_page_range(source: Union[bytes, str], start: int, stop: int) -> List[str]:
+    """
+    Extract text for pages [start, stop) with PDFium.
+    Module-level so it can run in a worker process; PDFium is not thread-safe,
+    so each process opens its own copy of the document.
+    """
+    import pypdfium2 as pdfium
+    pdf = pdfium.PdfDocument(source)
+    try:
+        page_texts = []
+        for page_index in range(start, stop):
+            page = pdf[page_index]
+            textpage = page.get_textpage()
+            page_texts.append(textpage.get_text_range())
+            textpage.close()
+            page.close()
+        return page_texts
+    finally:
+        pdf.close()
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    """
+    Return the PDF extraction pool, starting it on first use.
+    Workers come from a fork server (or are spawned where that is unavailable) instead of being
+    forked from the server process, whose threads may hold locks at the moment of the fork.
+    """
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _pdf_pool = ProcessPoolExecutor(max_workers=_pdf_max_workers, mp_context=multiprocessing.get_context(method))
+        return _pdf_pool
+
+def shutdown_pdf_pool():
+    """Stop the PDF extraction workers, if they were started."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is not None:
+            _pdf_pool.shutdown()
+            _pdf_pool = None
+
+def _as_file(source: Union[bytes, str]):
+    """
+    Return something the format readers can open: the path itself, or a file object over raw bytes.
+    """
+    return io.BytesIO(source) if isinstance(source, bytes) else source
+
 def _get_extension(filename):
     """
     Return the lowercase extension string of filename, handling if filename is a tuple/list.
@@ -30,9 +86,10 @@ class FileProcessor:
         }
 
     
-    def process_file(self, file_content: bytes, filename: str) -> Dict[str, Any]:
+    def process_file(self, source: Union[bytes, str], filename: str) -> Dict[str, Any]:
         """
-        Process uploaded file based on its extension
+        Process uploaded file based on its extension.
+        source is either the raw file bytes or a path to the file on disk.
         Returns: {
             'content': str,
             'metadata': dict,
@@ -40,7 +97,7 @@ class FileProcessor:
             'error': str (if any)
         }
         """
-        logger.info(f"Processing file: {filename}")
+        logger.info("Processing file: %s", filename)
         try:
             # Get file extension
             file_ext = _get_extension(filename)
@@ -58,16 +115,16 @@ class FileProcessor:
             
             # Process file based on extension
             processor = self.supported_formats[file_ext]
-            logger.info(f"Using processor: {processor.__name__}")
-            content = processor(file_content, filename)
+            logger.info("Using processor: %s", processor.__name__)
+            content = processor(source, filename)
             
-            logger.info(f"File processed successfully: {filename}")
+            logger.info("File processed successfully: %s", filename)
             return {
                 'content': content,
                 'metadata': {
                     'filename': filename,
                     'file_type': file_ext,
-                    'file_size': len(file_content),
+                    'file_size': len(source) if isinstance(source, bytes) else os.path.getsize(source),
                     'content_length': len(content)
                 },
                 'success': True,
@@ -84,51 +141,79 @@ class FileProcessor:
                 'error': error_msg
             }
     
-    def _process_txt(self, file_content: bytes, filename: str) -> str:
+    def _process_txt(self, source: Union[bytes, str], filename: str) -> str:
         """Process plain text files"""
+        if isinstance(source, bytes):
+            file_content = source
+        else:
+            with open(source, "rb") as f:
+                file_content = f.read()
         try:
             return file_content.decode('utf-8')
         except UnicodeDecodeError:
-            logger.warning(f"UTF-8 decoding failed for {filename}. Trying other encodings.")
-            # Try different encodings
-            for encoding in ['latin-1', 'cp1252', 'iso-8859-1']:
-                try:
-                    return file_content.decode(encoding)
-                except UnicodeDecodeError:
-                    continue
-            logger.error(f"Unable to decode text file with common encodings: {filename}")
-            raise Exception("Unable to decode text file with common encodings")
+            logger.warning("UTF-8 decoding failed for %s. Detecting encoding.", filename)
+            # Detect the encoding in a single pass instead of trial-decoding the whole file
+            import charset_normalizer
+            best_match = charset_normalizer.from_bytes(file_content).best()
+            if best_match is None:
+                # latin-1 maps every byte, so undetectable files are still accepted as before
+                logger.warning("Unable to detect text file encoding for %s. Falling back to latin-1.", filename)
+                return file_content.decode('latin-1')
+            return file_content.decode(best_match.encoding, errors='replace')
     
-    def _process_pdf(self, file_content: bytes, filename: str) -> str:
-        """Process PDF files using PyPDF2"""
+    def _extract_pdf_pages(self, source: Union[bytes, str]) -> List[str]:
+        """Extract the text of each PDF page using the configured backend"""
+        if getattr(config, "PDF_BACKEND", "pdfium") == "pypdf2":
+            from PyPDF2 import PdfReader
+            pdf_reader = PdfReader(_as_file(source))
+            return [page.extract_text() or "" for page in pdf_reader.pages]
+        
+        import pypdfium2 as pdfium
+        with _pdfium_lock:
+            pdf = pdfium.PdfDocument(source)
+            page_count = len(pdf)
+            pdf.close()
+        
+        workers = min(_pdf_max_workers, page_count // getattr(config, "PDF_PAGES_PER_WORKER", 25))
+        if workers <= 1:
+            with _pdfium_lock:
+                return _extract_pdfium_page_range(source, 0, page_count)
+        
+        # Split pages into contiguous ranges, one per worker, and join them back in page order
+        step = -(-page_count // workers)
+        starts = range(0, page_count, step)
+        stops = [min(start + step, page_count) for start in starts]
+        ranges = _get_pdf_pool().map(_extract_pdfium_page_range, [source] * len(starts), starts, stops)
+        return [page_text for page_texts in ranges for page_text in page_texts]
+    
+    def _process_pdf(self, source: Union[bytes, str], filename: str) -> str:
+        """Process PDF files using PDFium (or PyPDF2 when PDF_BACKEND is 'pypdf2')"""
         try:
-            pdf_file = io.BytesIO(file_content)
-            pdf_reader = PdfReader(pdf_file)
-            
             text_content = []
-            for page_num, page in enumerate(pdf_reader.pages):
-                page_text = page.extract_text()
+            for page_num, page_text in enumerate(self._extract_pdf_pages(source)):
                 if page_text.strip():
                     text_content.append(f"--- Page {page_num + 1} ---")
                     text_content.append(page_text)
             
             if not text_content:
-                logger.warning(f"No text content found in PDF: {filename}")
+                logger.warning("No text content found in PDF: %s", filename)
                 raise Exception("No text content found in PDF")
             
             return "\n\n".join(text_content)
             
         except Exception as e:
-            logger.error(f"Error processing PDF {filename}: {str(e)}", exc_info=True)
+            logger.error("Error processing PDF %s: %s", filename, e, exc_info=True)
             raise Exception(f"Error processing PDF: {str(e)}")
     
-    def _process_excel(self, file_content: bytes, filename: str) -> str:
+    def _process_excel(self, source: Union[bytes, str], filename: str) -> str:
         """Process Excel files (.xlsx, .xls)"""
+        import pandas as pd
         try:
-            excel_file = io.BytesIO(file_content)
+            excel_file = _as_file(source)
             
-            # Read all sheets
-            excel_data = pd.read_excel(excel_file, sheet_name=None)
+            # Read all sheets; .xlsx goes through the Rust calamine reader, legacy .xls keeps pandas' default engine
+            engine = "calamine" if _get_extension(filename) == ".xlsx" else None
+            excel_data = pd.read_excel(excel_file, sheet_name=None, engine=engine)
             
             text_content = []
             for sheet_name, df in excel_data.items():
@@ -136,16 +221,10 @@ class FileProcessor:
                 
                 # Convert DataFrame to readable text
                 if not df.empty:
-                    # Include column headers
-                    headers = "Columns: " + ", ".join(df.columns.astype(str))
-                    text_content.append(headers)
-                    
-                    # Convert rows to text (limit to first 1000 rows to avoid huge content)
+                    # Render rows as pipe-separated values with a single header line
+                    # (limit to first 1000 rows to avoid huge content)
                     max_rows = min(1000, len(df))
-                    for index, row in df.head(max_rows).iterrows():
-                        row_text = " | ".join([f"{col}: {val}" for col, val in row.items() if pd.notna(val)])
-                        if row_text.strip():
-                            text_content.append(f"Row {index + 1}: {row_text}")
+                    text_content.append(df.head(max_rows).to_csv(sep='|', index=False, na_rep='').rstrip("\n"))
                     
                     if len(df) > max_rows:
                         text_content.append(f"... (truncated, showing first {max_rows} of {len(df)} rows)")
@@ -155,13 +234,14 @@ class FileProcessor:
             return "\n\n".join(text_content)
             
         except Exception as e:
-            logger.error(f"Error processing Excel file {filename}: {str(e)}", exc_info=True)
+            logger.error("Error processing Excel file %s: %s", filename, e, exc_info=True)
             raise Exception(f"Error processing Excel file: {str(e)}")
     
-    def _process_docx(self, file_content: bytes, filename: str) -> str:
+    def _process_docx(self, source: Union[bytes, str], filename: str) -> str:
         """Process Word documents (.docx)"""
+        from docx import Document
         try:
-            docx_file = io.BytesIO(file_content)
+            docx_file = _as_file(source)
             doc = Document(docx_file)
             
             text_content = []
@@ -187,13 +267,13 @@ class FileProcessor:
                     text_content.extend(table_text)
             
             if not text_content:
-                logger.warning(f"No text content found in Word document: {filename}")
+                logger.warning("No text content found in Word document: %s", filename)
                 raise Exception("No text content found in Word document")
             
             return "\n\n".join(text_content)
             
         except Exception as e:
-            logger.error(f"Error processing Word document {filename}: {str(e)}", exc_info=True)
+            logger.error("Error processing Word document %s: %s", filename, e, exc_info=True)
             raise Exception(f"Error processing Word document: {str(e)}")
     
     def get_supported_formats(self) -> List[str]:
@@ -3,8 +3,12 @@ from firebase_admin import credentials, firestore, auth
 from config import config
 from logging_config import logger
 import secrets
+import hashlib
 import datetime
-import requests
+import threading
+import httpx
+from collections import Counter
+from cachetools import TTLCache
 
 def initialize_firebase():
     """
@@ -22,6 +26,17 @@ def initialize_firebase():
 
 initialize_firebase()
 
+_db = None
+
+def _get_db():
+    """
+    Return the shared Firestore client, creating it on first use. The client is thread-safe.
+    """
+    global _db
+    if _db is None:
+        _db = firestore.client()
+    return _db
+
 def verify_firebase_token(token: str):
     """
     Verify Firebase ID token.
@@ -36,52 +51,135 @@ def verify_firebase_token(token: str):
 
 from datetime import timezone
 
+def _hash_api_key(api_key: str) -> str:
+    """
+    Return the Firestore document id for an API key. Only the hash is stored, never the key itself.
+    """
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
 def generate_api_key(user_id: str, name: str = None) -> str:
     """
-    Generate a new API key for a user and store it in Firestore.
+    Generate a new API key for a user and store it in Firestore under its hash.
     """
-    db = firestore.client()
+    db = _get_db()
     api_key = secrets.token_hex(32)
     key_data = {
         'user_id': user_id,
-        'api_key': api_key,
         'name': name,
         'created_at': datetime.datetime.now(timezone.utc),
         'active': True,
         'usage_count': 0,
         'expires_at': datetime.datetime.now(timezone.utc) + datetime.timedelta(days=365) # Key expires in 1 year
     }
-    db.collection('api_keys').document(api_key).set(key_data)
+    db.collection('api_keys').document(_hash_api_key(api_key)).set(key_data)
     logger.info(f"Generated API key for user {user_id}" + (f" with name '{name}'" if name else ""))
     return api_key
 
-def validate_api_key(api_key: str):
+# usage_count increments buffered in memory and written by flush_usage_counts: {doc_id: count}
+_pending_usage = Counter()
+_pending_usage_lock = threading.Lock()
+# Firestore allows at most 500 writes per batch
+_MAX_BATCH_WRITES = 500
+
+def flush_usage_counts():
     """
-    Validate an API key and increment its usage count.
+    Write buffered usage_count increments to Firestore using batched writes.
     """
-    db = firestore.client()
-    key_ref = db.collection('api_keys').document(api_key)
-    key_doc = key_ref.get()
+    with _pending_usage_lock:
+        pending = list(_pending_usage.items())
+        _pending_usage.clear()
 
-    if not key_doc.exists:
-        return None
+    if not pending:
+        return
+
+    db = _get_db()
+    for start in range(0, len(pending), _MAX_BATCH_WRITES):
+        chunk = pending[start:start + _MAX_BATCH_WRITES]
+        try:
+            batch = db.batch()
+            for doc_id, count in chunk:
+                batch.update(db.collection('api_keys').document(doc_id), {'usage_count': firestore.Increment(count)})
+            batch.commit()
+        except Exception as e:
+            # A batch fails as a whole, e.g. when one of its keys was deleted; fall back to per-key updates
+            logger.warning(f"Batched usage count update failed, retrying per key: {str(e)}")
+            for doc_id, count in chunk:
+                try:
+                    db.collection('api_keys').document(doc_id).update({'usage_count': firestore.Increment(count)})
+                except Exception as e:
+                    logger.error(f"Failed to update usage count for API key {doc_id}: {str(e)}", exc_info=True)
+    logger.info(f"Flushed usage counts for {len(pending)} API keys")
+
+# Recently validated keys, so repeat requests skip Firestore: {key_hash: (doc_id, key_data)}
+_key_cache = TTLCache(
+    maxsize=getattr(config, "API_KEY_CACHE_SIZE", 10_000),
+    ttl=getattr(config, "API_KEY_CACHE_TTL", 60),
+)
+_key_cache_lock = threading.Lock()
 
-    key_data = key_doc.to_dict()
+def _invalidate_cached_key(doc_id: str):
+    # doc_id is the key hash, or the raw key for documents created before keys were hashed
+    with _key_cache_lock:
+        _key_cache.pop(doc_id, None)
+        _key_cache.pop(_hash_api_key(doc_id), None)
 
+def _accept_api_key(doc_id: str, key_data: dict):
+    """Return key_data if the key is active and unexpired, buffering its usage count increment."""
     if not key_data.get('active') or key_data.get('expires_at') < datetime.datetime.now(timezone.utc):
         return None
 
     # Increment usage count
-    key_ref.update({'usage_count': firestore.Increment(1)})
+    with _pending_usage_lock:
+        _pending_usage[doc_id] += 1
     
     return key_data
 
+def validate_cached_api_key(api_key: str):
+    """
+    Validate an API key against the cache only, without touching Firestore.
+    Returns None on a cache miss as well as for an invalid key; use validate_api_key then.
+    """
+    with _key_cache_lock:
+        cached = _key_cache.get(_hash_api_key(api_key))
+    return _accept_api_key(*cached) if cached else None
+
+def validate_api_key(api_key: str):
+    """
+    Validate an API key and record its usage.
+    Valid keys are cached for API_KEY_CACHE_TTL seconds; the usage count increment
+    is buffered and written later by flush_usage_counts.
+    """
+    key_hash = _hash_api_key(api_key)
+    with _key_cache_lock:
+        cached = _key_cache.get(key_hash)
+
+    if cached:
+        return _accept_api_key(*cached)
+
+    db = _get_db()
+    key_ref = db.collection('api_keys').document(key_hash)
+    key_doc = key_ref.get()
+
+    if not key_doc.exists:
+        # Keys created before hashing was introduced are stored under the raw key
+        key_ref = db.collection('api_keys').document(api_key)
+        key_doc = key_ref.get()
+        if not key_doc.exists:
+            return None
+
+    doc_id, key_data = key_ref.id, key_doc.to_dict()
+    key_data = _accept_api_key(doc_id, key_data)
+    if key_data:
+        with _key_cache_lock:
+            _key_cache[key_hash] = (doc_id, key_data)
+    return key_data
+
 def get_user_api_keys(user_id: str) -> list:
     """
     Retrieve all API keys for a specific user from Firestore.
     """
     try:
-        db = firestore.client()
+        db = _get_db()
         # Query for all API keys belonging to the user
         keys_query = db.collection('api_keys').where('user_id', '==', user_id)
         keys_docs = keys_query.stream()
@@ -114,7 +212,16 @@ def create_firebase_user(email, password):
         logger.error(f"Failed to create user: {str(e)}", exc_info=True)
         return None
 
-def login_with_email_and_password(email, password):
+# Shared client so logins reuse pooled keep-alive connections to the Auth REST API
+_http = httpx.AsyncClient(http2=True, timeout=5.0)
+
+async def close_http_client():
+    """
+    Close the shared HTTP client. Called on application shutdown.
+    """
+    await _http.aclose()
+
+async def login_with_email_and_password(email, password):
     """
     Sign in a user with email and password using Firebase Auth REST API.
     Returns the user's UID and ID token if successful, otherwise None.
@@ -126,14 +233,14 @@ def login_with_email_and_password(email, password):
         "returnSecureToken": True
     }
     try:
-        response = requests.post(rest_api_url, json=payload)
+        response = await _http.post(rest_api_url, json=payload)
         response.raise_for_status()  # Raise an exception for bad status codes
         data = response.json()
         user_id = data["localId"]
         id_token = data["idToken"]
         logger.info(f"User {user_id} logged in successfully.")
         return user_id, id_token
-    except requests.exceptions.HTTPError as e:
+    except httpx.HTTPStatusError as e:
         logger.error(f"Failed to login user: {e.response.text}", exc_info=True)
         return None, None
     except Exception as e:
@@ -147,7 +254,7 @@ def delete_api_key(api_key: str, user_id: str = None) -> bool:
     Returns True if deleted, False if not found or not permitted.
     """
     try:
-        db = firestore.client()
+        db = _get_db()
         key_ref = db.collection('api_keys').document(api_key)
         key_doc = key_ref.get()
 
@@ -163,6 +270,7 @@ def delete_api_key(api_key: str, user_id: str = None) -> bool:
             return False
 
         key_ref.delete()
+        _invalidate_cached_key(api_key)
         logger.info(
             f"Deleted API key {api_key}" + (f" for user {user_id}" if user_id else "")
         )
@@ -177,7 +285,7 @@ def set_api_key_active(api_key: str, active: bool) -> bool:
     Returns True if updated, False otherwise.
     """
     try:
-        db = firestore.client()
+        db = _get_db()
         key_ref = db.collection('api_keys').document(api_key)
         key_doc = key_ref.get()
 
@@ -186,6 +294,7 @@ def set_api_key_active(api_key: str, active: bool) -> bool:
             return False
 
         key_ref.update({'active': active})
+        _invalidate_cached_key(api_key)
         logger.info(f"Set API key {api_key} active={active}")
         return True
     except Exception as e:
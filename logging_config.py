@@ -1,6 +1,8 @@
+import atexit
 import logging
+import queue
 import sys
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 # Define log format
 LOG_FORMAT = "%(asctime)s - %(levelname)s - %(name)s - %(module)s - %(funcName)s - %(lineno)d - %(message)s"
@@ -8,6 +10,8 @@ LOG_FORMAT = "%(asctime)s - %(levelname)s - %(name)s - %(module)s - %(funcName)s
 def setup_logging():
     """
     Set up logging for the application.
+    Records are handed to a queue and written by a background listener thread,
+    so request handlers never block on console or file I/O.
     """
     # Get root logger
     logger = logging.getLogger()
@@ -27,9 +31,12 @@ def setup_logging():
     file_handler.setLevel(logging.ERROR)
     file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
     
-    # Add handlers to the logger
-    logger.addHandler(stdout_handler)
-    logger.addHandler(file_handler)
+    # Route records through a queue to the handlers
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, stdout_handler, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    logger.addHandler(QueueHandler(log_queue))
     
     return logger
 
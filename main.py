@@ -1,26 +1,35 @@
-from fastapi import FastAPI, HTTPException, File, UploadFile, Request, Depends, Header
+from fastapi import FastAPI, HTTPException, File, UploadFile, Request, Depends, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer
+from fastapi.responses import ORJSONResponse
 import uvicorn
-from typing import List, Optional
+from typing import List, Optional, Dict, Any
+import asyncio
 import json
+import logging
+import os
+import shutil
+import tempfile
 import time
 
 from logging_config import logger
 
 from models import DocumentUpload, QueryRequest, QueryResponse, APIResponse, UserCreate, UserLogin
 from embedding_service import embedding_service
-from vector_store import vector_store
-from query_service import rag_orchestrator
-from file_processor import file_processor
-from firebase_admin_auth import verify_firebase_token, generate_api_key, validate_api_key, create_firebase_user, login_with_email_and_password
-from firebase_admin_auth import delete_api_key, set_api_key_active
+from vector_store import FAISSVectorStore
+from query_service import RAGOrchestrator
+from file_processor import file_processor, shutdown_pdf_pool
+from firebase_admin_auth import verify_firebase_token, generate_api_key, validate_api_key, validate_cached_api_key, create_firebase_user, login_with_email_and_password
+from firebase_admin_auth import delete_api_key, set_api_key_active, flush_usage_counts, close_http_client
+from config import config
 
 # Initialize FastAPI app
 app = FastAPI(
     title="Simple RAG API",
     description="A simple Retrieval-Augmented Generation API using FastAPI, FAISS, and OpenAI",
-    version="1.0.0"
+    version="1.0.0",
+    # orjson serializes the chunk-heavy /query payloads considerably faster than json.dumps
+    default_response_class=ORJSONResponse
 )
 
 # Add CORS middleware
@@ -39,13 +48,17 @@ http_bearer_scheme = HTTPBearer()
 api_key_scheme = APIKeyHeader(name='X-API-Key')
 
 async def get_current_user(token: str = Depends(http_bearer_scheme)) -> str:
-    user_id = verify_firebase_token(token.credentials)
+    # Token verification may fetch Google's signing certificates; keep it off the event loop
+    user_id = await asyncio.to_thread(verify_firebase_token, token.credentials)
     if not user_id:
         raise HTTPException(status_code=401, detail="Invalid or expired token")
     return user_id
 
 async def get_current_user_id_from_api_key(x_api_key: str = Depends(api_key_scheme)) -> str:
-    key_data = validate_api_key(x_api_key)
+    # Cached keys are checked inline; only cache misses read the key from Firestore in a thread
+    key_data = validate_cached_api_key(x_api_key)
+    if not key_data:
+        key_data = await asyncio.to_thread(validate_api_key, x_api_key)
     if not key_data:
         raise HTTPException(status_code=401, detail="Invalid or expired API Key")
     user_id = key_data.get('user_id')
@@ -53,19 +66,126 @@ async def get_current_user_id_from_api_key(x_api_key: str = Depends(api_key_sche
         raise HTTPException(status_code=401, detail="API Key is not associated with a user")
     return user_id
 
+def get_vector_store(request: Request) -> FAISSVectorStore:
+    return request.app.state.vector_store
+
+def get_rag_orchestrator(request: Request) -> RAGOrchestrator:
+    return request.app.state.rag_orchestrator
+
+async def flush_usage_counts_periodically():
+    """
+    Write buffered API key usage counts to Firestore every USAGE_FLUSH_INTERVAL seconds.
+    """
+    interval = getattr(config, "USAGE_FLUSH_INTERVAL", 5)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(flush_usage_counts)
+        except Exception as e:
+            logger.error(f"Failed to flush API key usage counts: {str(e)}", exc_info=True)
+
+async def checkpoint_indexes_periodically():
+    """
+    Fold the vector store's write-ahead logs into full index snapshots every WAL_CHECKPOINT_INTERVAL seconds.
+    """
+    interval = getattr(config, "WAL_CHECKPOINT_INTERVAL", 30)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(app.state.vector_store.checkpoint_all)
+        except Exception as e:
+            logger.error(f"Failed to checkpoint vector indexes: {str(e)}", exc_info=True)
+
+_background_tasks = set()
+
+@app.on_event("startup")
+async def init_services():
+    """
+    Build the vector store and RAG orchestrator when the app starts rather than at import time.
+    """
+    app.state.vector_store = await asyncio.to_thread(FAISSVectorStore)
+    app.state.rag_orchestrator = RAGOrchestrator(app.state.vector_store)
+
+@app.on_event("startup")
+async def start_background_tasks():
+    coros = [flush_usage_counts_periodically(), checkpoint_indexes_periodically()]
+    # Load saved user indexes in the background so the first query per user doesn't pay for it
+    if getattr(config, "WARM_INDEXES_ON_STARTUP", True):
+        coros.append(asyncio.to_thread(app.state.vector_store.warm_all_users))
+    for coro in coros:
+        task = asyncio.create_task(coro)
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    for task in list(_background_tasks):
+        task.cancel()
+    # Persist whatever was counted or logged since the last flush
+    await asyncio.to_thread(flush_usage_counts)
+    await asyncio.to_thread(app.state.vector_store.checkpoint_all)
+    await asyncio.to_thread(shutdown_pdf_pool)
+    await close_http_client()
+    await embedding_service.aclose()
+    await app.state.rag_orchestrator.aclose()
+
+# Embedding jobs submitted to the OpenAI Batch API: {batch_id: job}
+batch_jobs: Dict[str, Dict[str, Any]] = {}
+
+async def complete_batch_job(batch_id: str, vector_store: FAISSVectorStore):
+    """
+    Poll a Batch API job until it finishes, then add its embeddings to the user's vector store.
+    """
+    job = batch_jobs[batch_id]
+    poll_interval = getattr(config, "BATCH_POLL_INTERVAL", 60)
+    try:
+        while True:
+            batch = await embedding_service.get_batch(batch_id)
+            job["status"] = batch.status
+            if batch.status == "completed":
+                break
+            if batch.status in ("failed", "expired", "cancelled"):
+                logger.error(f"Embedding batch {batch_id} for user {job['user_id']} ended with status {batch.status}")
+                return
+            await asyncio.sleep(poll_interval)
+        
+        embeddings = await embedding_service.fetch_batch_embeddings(batch, job["chunks"])
+        processed_data = {
+            "chunks": job["chunks"],
+            "embeddings": embeddings,
+            "metadata": job["metadata"],
+            "total_chunks": len(job["chunks"])
+        }
+        await asyncio.to_thread(vector_store.add_documents, job["user_id"], processed_data)
+        job["status"] = "stored"
+        logger.info(f"Embedding batch {batch_id} stored {len(job['chunks'])} chunks for user {job['user_id']}")
+    except Exception as e:
+        job["status"] = "failed"
+        job["error"] = str(e)
+        logger.error(f"Error completing embedding batch {batch_id}: {str(e)}", exc_info=True)
+    finally:
+        # The chunks are no longer needed once the job has finished; the job itself is kept for
+        # BATCH_JOB_RETENTION seconds so its final status can still be polled
+        job.pop("chunks", None)
+        asyncio.get_running_loop().call_later(
+            getattr(config, "BATCH_JOB_RETENTION", 3600), batch_jobs.pop, batch_id, None
+        )
+
+_UNLOGGED_PATHS = frozenset({"/", "/docs"})
+
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
     """
-    Log incoming requests and their processing time.
+    Log each request with its status and processing time in a single line.
+    Health checks and the docs page are not logged.
     """
-    start_time = time.time()
-    logger.info(f"Request: {request.method} {request.url.path}")
+    path = request.url.path
+    if path in _UNLOGGED_PATHS or not logger.isEnabledFor(logging.INFO):
+        return await call_next(request)
     
+    start_ns = time.perf_counter_ns()
     response = await call_next(request)
-    
-    process_time = time.time() - start_time
-    logger.info(f"Response: {response.status_code} - Process time: {process_time:.4f}s")
-    
+    logger.info("%s %s -> %d in %.4fs", request.method, path, response.status_code, (time.perf_counter_ns() - start_ns) / 1e9)
     return response
 
 @app.get("/")
@@ -78,7 +198,7 @@ async def register_user(user_data: UserCreate):
     """
     Register a new user.
     """
-    user_id = create_firebase_user(user_data.email, user_data.password)
+    user_id = await asyncio.to_thread(create_firebase_user, user_data.email, user_data.password)
     if not user_id:
         raise HTTPException(status_code=400, detail="Could not create user. The email might already be in use.")
     
@@ -89,7 +209,7 @@ async def login_for_id_token(user_data: UserLogin):
     """
     Login a user and return an ID token.
     """
-    user_id, id_token = login_with_email_and_password(user_data.email, user_data.password)
+    user_id, id_token = await login_with_email_and_password(user_data.email, user_data.password)
     if not user_id:
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
@@ -99,7 +219,7 @@ async def login_for_id_token(user_data: UserLogin):
 @app.post("/generate-key")
 async def generate_new_api_key(user_id: str = Depends(get_current_user), name: Optional[str] = None):
     """Generate a new API key for the authenticated user."""
-    api_key = generate_api_key(user_id, name)
+    api_key = await asyncio.to_thread(generate_api_key, user_id, name)
     return APIResponse(success=True, message="API Key generated successfully", data={"api_key": api_key, "name": name})
 
 @app.get("/api-keys")
@@ -107,7 +227,7 @@ async def get_user_api_keys_endpoint(user_id: str = Depends(get_current_user)):
     """Retrieve all API keys for the authenticated user."""
     from firebase_admin_auth import get_user_api_keys
     try:
-        user_keys = get_user_api_keys(user_id)
+        user_keys = await asyncio.to_thread(get_user_api_keys, user_id)
         return APIResponse(
             success=True, 
             message="API keys retrieved successfully", 
@@ -121,7 +241,7 @@ async def get_user_api_keys_endpoint(user_id: str = Depends(get_current_user)):
 async def delete_user_api_key(key_id: str, user_id: str = Depends(get_current_user)):
     """Delete a specific API key belonging to the authenticated user."""
     try:
-        deleted = delete_api_key(key_id, user_id)
+        deleted = await asyncio.to_thread(delete_api_key, key_id, user_id)
         if not deleted:
             raise HTTPException(status_code=404, detail="API key not found or not owned by user")
         return APIResponse(success=True, message="API key deleted successfully")
@@ -139,7 +259,7 @@ async def set_user_api_key_active(key_id: str, request: Request, user_id: str =
         body = await request.json()
         active = bool(body.get("active"))
 
-        updated = set_api_key_active(key_id, active)
+        updated = await asyncio.to_thread(set_api_key_active, key_id, active)
         if not updated:
             raise HTTPException(status_code=404, detail="API key not found")
         return APIResponse(success=True, message="API key status updated", data={"active": active})
@@ -165,10 +285,10 @@ async def get_supported_formats():
     }
 
 @app.get("/stats")
-async def get_stats(user_id: str = Depends(get_current_user_id_from_api_key)):
+async def get_stats(user_id: str = Depends(get_current_user_id_from_api_key), vector_store: FAISSVectorStore = Depends(get_vector_store)):
     """Get vector database statistics for the current user."""
     try:
-        stats = vector_store.get_stats(user_id)
+        stats = await asyncio.to_thread(vector_store.get_stats, user_id)
         return APIResponse(
             success=True,
             message="Statistics retrieved successfully",
@@ -179,19 +299,19 @@ async def get_stats(user_id: str = Depends(get_current_user_id_from_api_key)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/upload/text")
-async def upload_text_document(document: DocumentUpload, user_id: str = Depends(get_current_user_id_from_api_key)):
+async def upload_text_document(document: DocumentUpload, user_id: str = Depends(get_current_user_id_from_api_key), vector_store: FAISSVectorStore = Depends(get_vector_store)):
     """
     Upload and process text document for embedding and storage for the current user.
     """
     try:
         # Process the document
-        processed_data = embedding_service.process_document(
+        processed_data = await embedding_service.aprocess_document(
             content=document.content,
             metadata=document.metadata
         )
         
         # Add to vector store for the specific user
-        success = vector_store.add_documents(user_id, processed_data)
+        success = await asyncio.to_thread(vector_store.add_documents, user_id, processed_data)
         
         if success:
             return APIResponse(
@@ -207,26 +327,56 @@ async def upload_text_document(document: DocumentUpload, user_id: str = Depends(
         raise HTTPException(status_code=500, detail=f"Document processing failed: {str(e)}")
 
 @app.post("/upload/file")
-async def upload_file_document(user_id: str = Depends(get_current_user_id_from_api_key), file: UploadFile = File(...)):
+async def upload_file_document(
+    user_id: str = Depends(get_current_user_id_from_api_key),
+    vector_store: FAISSVectorStore = Depends(get_vector_store),
+    file: UploadFile = File(...),
+    async_mode: bool = Query(False, alias="async", description="Embed through the OpenAI Batch API and store the chunks in the background")
+):
     """Upload and process various file formats for the current user."""
+    tmp_path = None
     try:
-        # Read file content
-        file_content = await file.read()
+        # Spool the upload to disk instead of holding the whole file in memory
+        with tempfile.NamedTemporaryFile(delete=False) as tmp:
+            tmp_path = tmp.name
+            await asyncio.to_thread(shutil.copyfileobj, file.file, tmp)
         
         # Process file based on its format
-        processing_result = file_processor.process_file(file_content, file.filename)
+        processing_result = await asyncio.to_thread(file_processor.process_file, tmp_path, file.filename)
         
         if not processing_result['success']:
             raise HTTPException(status_code=400, detail=processing_result['error'])
         
+        if async_mode:
+            chunks = embedding_service.chunk_text(processing_result['content'])
+            if not chunks:
+                raise HTTPException(status_code=400, detail="No text content to embed")
+            batch_id = await embedding_service.submit_batch(chunks)
+            batch_jobs[batch_id] = {
+                "user_id": user_id,
+                "filename": file.filename,
+                "chunks": chunks,
+                "metadata": processing_result['metadata'],
+                "total_chunks": len(chunks),
+                "status": "submitted"
+            }
+            task = asyncio.create_task(complete_batch_job(batch_id, vector_store))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+            return APIResponse(
+                success=True,
+                message=f"File '{file.filename}' submitted for batch embedding with {len(chunks)} chunks.",
+                data={"batch_id": batch_id, "chunks_submitted": len(chunks)}
+            )
+        
         # Process the extracted content
-        processed_data = embedding_service.process_document(
+        processed_data = await embedding_service.aprocess_document(
             content=processing_result['content'],
             metadata=processing_result['metadata']
         )
         
         # Add to vector store for the specific user
-        success = vector_store.add_documents(user_id, processed_data)
+        success = await asyncio.to_thread(vector_store.add_documents, user_id, processed_data)
         
         if success:
             return APIResponse(
@@ -247,33 +397,57 @@ async def upload_file_document(user_id: str = Depends(get_current_user_id_from_a
     except Exception as e:
         logger.error(f"Error processing file for user {user_id}: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"File processing failed: {str(e)}")
+    finally:
+        if tmp_path:
+            os.remove(tmp_path)
+
+@app.get("/batch/{batch_id}/status")
+async def get_batch_status(batch_id: str, user_id: str = Depends(get_current_user_id_from_api_key)):
+    """Get the status of a batch embedding job submitted by the current user."""
+    job = batch_jobs.get(batch_id)
+    if not job or job["user_id"] != user_id:
+        raise HTTPException(status_code=404, detail="Batch job not found")
+    
+    return APIResponse(
+        success=True,
+        message=f"Batch job is {job['status']}",
+        data={
+            "batch_id": batch_id,
+            "filename": job["filename"],
+            "status": job["status"],
+            "total_chunks": job["total_chunks"],
+            "error": job.get("error")
+        }
+    )
 
 @app.post("/query", response_model=QueryResponse)
-async def query_documents(request: QueryRequest, user_id: str = Depends(get_current_user_id_from_api_key)):
+async def query_documents(request: QueryRequest, user_id: str = Depends(get_current_user_id_from_api_key), rag_orchestrator: RAGOrchestrator = Depends(get_rag_orchestrator)):
     """
     Query the knowledge base for the current user and get AI-generated response.
     """
     try:
         # Process query through RAG pipeline for the specific user
-        result = rag_orchestrator.process_query(request.query, user_id)
+        result = await rag_orchestrator.process_query(request.query, user_id)
         
-        return QueryResponse(
-            answer=result["answer"],
-            sources=result["sources"][:request.max_results],
-            confidence=1.0 if result["context_used"] else 0.0
-        )
+        # Returned as a response directly: the payload is built here, so FastAPI's second
+        # pass of QueryResponse validation would only re-check it. response_model still documents the shape.
+        return ORJSONResponse({
+            "answer": result["answer"],
+            "sources": result["sources"][:request.max_results],
+            "confidence": 1.0 if result["context_used"] else 0.0
+        })
         
     except Exception as e:
         logger.error(f"Error processing query for user {user_id}: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Query processing failed: {str(e)}")
 
 @app.delete("/clear")
-async def clear_database(user_id: str = Depends(get_current_user)):
+async def clear_database(user_id: str = Depends(get_current_user), vector_store: FAISSVectorStore = Depends(get_vector_store)):
     """
     Clear all documents from the vector database for the current user.
     """
     try:
-        deleted = vector_store.clear_user_index(user_id)
+        deleted = await asyncio.to_thread(vector_store.clear, user_id)
         
         if deleted:
             return APIResponse(
@@ -290,4 +464,16 @@ async def clear_database(user_id: str = Depends(get_current_user)):
         raise HTTPException(status_code=500, detail=f"Failed to clear database: {str(e)}")
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Requests are already logged by log_requests, so uvicorn's access log is disabled.
+    # Each worker keeps its own index cache, write-ahead log handles, semantic cache and
+    # batch job table, so only raise WEB_CONCURRENCY when user traffic is pinned to a worker
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", 1)),
+        loop="uvloop",
+        http="httptools",
+        access_log=False,
+        log_level="warning"
+    )
@@ -1,30 +1,48 @@
 import openai
+import asyncio
+import httpx
 from typing import List, Dict, Any
 from langgraph.graph import StateGraph, END
 from config import config
 from embedding_service import embedding_service
-from vector_store import vector_store
+from vector_store import FAISSVectorStore
+from semantic_cache import semantic_cache
 from logging_config import logger
 
 class DataFetchingTool:
     """Tool for fetching additional data from configured sources"""
     
-    def __init__(self):
+    def __init__(self, vector_store: FAISSVectorStore):
         self.data_sources = config.get_data_source_config()
+        self.vector_store = vector_store
     
-    def fetch_data(self, state: Dict[str, Any]) -> Dict[str, Any]:
+    async def fetch_data(self, state: Dict[str, Any]) -> Dict[str, Any]:
         """
         Fetch additional data based on configuration for a specific user.
         """
         user_id = state['user_id']
         logger.info(f"Fetching data for query: {state['query']} for user: {user_id}")
         try:
-            # Create embedding for the query (returns list, take first element)
-            query_embeddings = embedding_service.create_embeddings([state["query"]])
+            # Create embedding for the query (returns a matrix, take the first row) while
+            # the user's index is loaded from disk, instead of after it
+            query_embeddings, _ = await asyncio.gather(
+                embedding_service.acreate_embeddings([state["query"]]),
+                asyncio.to_thread(self.vector_store.preload, user_id)
+            )
             query_embedding = query_embeddings[0]  # Extract single embedding
+            state["query_embedding"] = query_embedding
+            state["generation"] = self.vector_store.get_generation(user_id)
+            
+            # A paraphrase of a recent query is answered from the semantic cache
+            cached = semantic_cache.get(user_id, state["generation"], query_embedding)
+            if cached is not None:
+                state["retrieved_docs"] = cached["retrieved_docs"]
+                state["answer"] = cached["answer"]
+                state["cache_hit"] = True
+                return state
             
             # Search in vector store for the specific user
-            results = vector_store.search(user_id, query_embedding, k=5)
+            results = await self.vector_store.search_async(user_id, query_embedding, k=5)
             logger.info(f"Found {len(results)} relevant documents for user {user_id}.")
             
             # Update state with results
@@ -40,6 +58,8 @@ class DataFetchingTool:
             return state
         except Exception as e:
             logger.info(f"Data fetching error for user {user_id}: {str(e)}", exc_info=True)
+            # Answers generated without retrieval must not be cached
+            state.pop("query_embedding", None)
             state["retrieved_docs"] = []
             state["context"] = ""
             return state
@@ -49,9 +69,19 @@ class QueryAnsweringTool:
     """Tool for generating answers using retrieved context"""
     
     def __init__(self):
-        openai.api_key = config.OPENAI_API_KEY
+        # One client for all requests, keeping HTTP/2 connections to the API open between queries
+        self.client = openai.AsyncOpenAI(
+            api_key=config.OPENAI_API_KEY,
+            http_client=httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(
+                    max_connections=getattr(config, "OPENAI_MAX_CONNECTIONS", 64),
+                    max_keepalive_connections=getattr(config, "OPENAI_MAX_KEEPALIVE_CONNECTIONS", 32)
+                )
+            )
+        )
     
-    def generate_answer(self, state: Dict[str, Any]) -> Dict[str, Any]:
+    async def generate_answer(self, state: Dict[str, Any]) -> Dict[str, Any]:
         """
         Generate answer using OpenAI GPT model with retrieved context
         """
@@ -70,7 +100,7 @@ class QueryAnsweringTool:
             """
             
             # Call OpenAI API
-            response = openai.chat.completions.create(
+            response = await self.client.chat.completions.create(
                 model=config.OPENAI_MODEL,
                 messages=[
                     {"role": "system", "content": "You are a helpful assistant that answers questions based on provided context."},
@@ -82,6 +112,8 @@ class QueryAnsweringTool:
             
             state["answer"] = response.choices[0].message.content
             logger.info("Answer generated successfully.")
+            if state.get("query_embedding") is not None:
+                semantic_cache.put(state["user_id"], state["generation"], state["query_embedding"], state["answer"], state["retrieved_docs"])
             return state
             
         except Exception as e:
@@ -93,8 +125,8 @@ class QueryAnsweringTool:
 class RAGOrchestrator:
     """LangGraph orchestrator for RAG workflow"""
     
-    def __init__(self):
-        self.data_fetcher = DataFetchingTool()
+    def __init__(self, vector_store: FAISSVectorStore):
+        self.data_fetcher = DataFetchingTool(vector_store)
         self.answer_generator = QueryAnsweringTool()
         self.workflow = self._create_workflow()
     
@@ -109,12 +141,23 @@ class RAGOrchestrator:
         
         # Define the workflow edges
         workflow.set_entry_point("fetch_data")
-        workflow.add_edge("fetch_data", "generate_answer")
+        # Semantic cache hits already carry an answer and skip generation
+        workflow.add_conditional_edges(
+            "fetch_data",
+            lambda state: "cached" if state.get("cache_hit") else "generate",
+            {"cached": END, "generate": "generate_answer"}
+        )
         workflow.add_edge("generate_answer", END)
         
         return workflow.compile()
     
-    def process_query(self, query: str, user_id: str) -> Dict[str, Any]:
+    async def aclose(self):
+        """
+        Close the answer generator's pooled connections.
+        """
+        await self.answer_generator.client.close()
+    
+    async def process_query(self, query: str, user_id: str) -> Dict[str, Any]:
         """
         Process a user query through the RAG pipeline for a specific user.
         """
@@ -126,11 +169,12 @@ class RAGOrchestrator:
                 "user_id": user_id,
                 "retrieved_docs": [],
                 "context": "",
-                "answer": ""
+                "answer": "",
+                "cache_hit": False
             }
             
             # Run the workflow
-            final_state = self.workflow.invoke(initial_state)
+            final_state = await self.workflow.ainvoke(initial_state)
             
             # Prepare response
             response = {
@@ -156,7 +200,3 @@ class RAGOrchestrator:
                 "sources": [],
                 "context_used": False
             }
-
-
-# Initialize RAG orchestrator
-rag_orchestrator = RAGOrchestrator()
\ No newline at end of file
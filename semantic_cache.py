@@ -0,0 +1,96 @@
+import threading
+import time
+import numpy as np
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional
+from config import config
+from logging_config import logger
+
+class _UserCache:
+    """Cached answers for one user, with their normalized query embeddings stacked in a matrix."""
+
+    def __init__(self, generation: int, dimension: int):
+        self.generation = generation
+        self.vectors = np.empty((0, dimension), dtype=np.float32)
+        self.entries: List[Dict[str, Any]] = []
+
+class SemanticCache:
+    """
+    In-process cache of answers keyed by query embedding.
+
+    A query whose embedding has cosine similarity >= threshold with a cached query is answered
+    from the cache, skipping both the vector search and the LLM call. Entries are tagged with
+    the vector store generation of the user's index, so any upload or clear invalidates them.
+    At most max_users users are cached; the least recently used one is dropped beyond that.
+    """
+
+    def __init__(self, dimension: int = 1536):
+        self.dimension = dimension
+        self.threshold = getattr(config, "SEMANTIC_CACHE_THRESHOLD", 0.95)
+        self.ttl = getattr(config, "SEMANTIC_CACHE_TTL", 3600)
+        self.max_entries = getattr(config, "SEMANTIC_CACHE_MAX_ENTRIES", 256)
+        self.max_users = getattr(config, "SEMANTIC_CACHE_MAX_USERS", getattr(config, "MAX_LOADED_USERS", 256))
+        self._users: "OrderedDict[str, _UserCache]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding: np.ndarray) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _user_cache(self, user_id: str, generation: int) -> _UserCache:
+        user_cache = self._users.get(user_id)
+        if user_cache is None or user_cache.generation != generation:
+            user_cache = self._users[user_id] = _UserCache(generation, self.dimension)
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+        return user_cache
+
+    def _prune(self, user_cache: _UserCache):
+        """Drop expired entries, then the oldest ones beyond max_entries."""
+        cutoff = time.monotonic() - self.ttl
+        keep = [i for i, entry in enumerate(user_cache.entries) if entry["created_at"] >= cutoff][-self.max_entries:]
+        if len(keep) < len(user_cache.entries):
+            user_cache.vectors = user_cache.vectors[keep]
+            user_cache.entries = [user_cache.entries[i] for i in keep]
+
+    def get(self, user_id: str, generation: int, query_embedding: np.ndarray) -> Optional[Dict[str, Any]]:
+        """Return the cached {"answer", "retrieved_docs"} for a similar query, or None."""
+        with self._lock:
+            user_cache = self._users.get(user_id)
+            if user_cache is None:
+                return None
+            if user_cache.generation != generation:
+                del self._users[user_id]
+                return None
+            self._prune(user_cache)
+            if not user_cache.entries:
+                del self._users[user_id]
+                return None
+            self._users.move_to_end(user_id)
+
+            similarities = user_cache.vectors @ self._normalize(query_embedding)
+            best = int(np.argmax(similarities))
+            entry = user_cache.entries[best]
+            if similarities[best] < self.threshold:
+                return None
+
+            logger.info(f"Semantic cache hit for user {user_id} (similarity {similarities[best]:.3f}).")
+            return {"answer": entry["answer"], "retrieved_docs": entry["retrieved_docs"]}
+
+    def put(self, user_id: str, generation: int, query_embedding: np.ndarray, answer: str, retrieved_docs: List[Dict[str, Any]]):
+        """Cache an answer computed against the given generation of the user's index."""
+        with self._lock:
+            user_cache = self._user_cache(user_id, generation)
+            user_cache.vectors = np.vstack((user_cache.vectors, self._normalize(query_embedding)))
+            user_cache.entries.append({
+                "answer": answer,
+                "retrieved_docs": retrieved_docs,
+                "created_at": time.monotonic()
+            })
+            self._prune(user_cache)
+
+# Initialize semantic cache
+semantic_cache = SemanticCache()
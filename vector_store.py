@@ -1,17 +1,55 @@
 import faiss
+import asyncio
+import glob
 import numpy as np
-import pickle
+import json
 import os
-from typing import List, Dict, Any, Tuple
+import struct
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
 from config import config
 from logging_config import logger
-import shutil
+from document_store import DocumentStore, fsync_path
+
+# WAL record header: first doc_id of the upload, number of rows, embedding dimension, payload length
+_WAL_HEADER = struct.Struct("<QIIQ")
 
 class FAISSVectorStore:
     def __init__(self):
         self.dimension = 1536  # OpenAI embedding dimension
         self.base_path = config.VECTOR_DB_PATH
-        self.indexes = {}  # Cache for user indexes: {user_id: (index, documents)}
+        # LRU cache of loaded user indexes: {user_id: (index, documents)}. Once more than
+        # max_loaded_users are resident, the least recently used clean one is dropped
+        self.indexes: "OrderedDict[str, Tuple[faiss.Index, DocumentStore]]" = OrderedDict()
+        self.max_loaded_users = getattr(config, "MAX_LOADED_USERS", 256)
+        # Threads used by warm_all_users to read user snapshots from disk
+        self.warm_workers = getattr(config, "INDEX_WARM_WORKERS", 16)
+        # Indexes switch from exact IndexFlatIP to approximate HNSW once they reach this many vectors
+        self.hnsw_threshold = getattr(config, "HNSW_THRESHOLD", 10_000)
+        self.hnsw_m = getattr(config, "HNSW_M", 32)
+        self.hnsw_ef_construction = getattr(config, "HNSW_EF_CONSTRUCTION", 200)
+        self.hnsw_ef_search = getattr(config, "HNSW_EF_SEARCH", 64)
+        # HNSW indexes store vectors as 8-bit scalar-quantized codes (1 byte/dim instead of 4);
+        # set HNSW_SCALAR_QUANTIZER = False to keep full fp32 vectors
+        self.hnsw_scalar_quantizer = getattr(config, "HNSW_SCALAR_QUANTIZER", True)
+        # Concurrent search_async calls for the same user are coalesced into one FAISS search
+        self.search_batch_window = getattr(config, "SEARCH_BATCH_WINDOW_MS", 5) / 1000
+        self.search_batch_max_size = getattr(config, "SEARCH_BATCH_MAX_SIZE", 64)
+        self._search_queues: Dict[str, asyncio.Queue] = {}
+        self._search_tasks = set()
+        # Each user's index is loaded, searched and updated under that user's lock, so tenants never
+        # wait on each other; the store lock only guards the index cache and the bookkeeping below
+        self._lock = threading.RLock()
+        self._user_locks: Dict[str, threading.RLock] = {}
+        # Uploads are appended to a per-user write-ahead log; the full index is only
+        # rewritten by checkpoint_all or once the log grows past wal_max_bytes
+        self.wal_max_bytes = getattr(config, "WAL_MAX_BYTES", 10 * 1024 * 1024)
+        self._dirty_users = set()
+        # Bumped whenever a user's documents change so derived caches can detect stale entries
+        self._generations: Dict[str, int] = {}
         
         # Create base directory if it doesn't exist
         os.makedirs(self.base_path, exist_ok=True)
@@ -19,45 +57,296 @@ class FAISSVectorStore:
     def _get_user_index_path(self, user_id: str) -> str:
         return os.path.join(self.base_path, user_id)
 
+    def _get_wal_path(self, user_id: str) -> str:
+        return os.path.join(self._get_user_index_path(user_id), "wal.bin")
+
+    def _user_lock(self, user_id: str) -> threading.RLock:
+        """Return the lock serializing access to one user's index."""
+        with self._lock:
+            lock = self._user_locks.get(user_id)
+            if lock is None:
+                lock = self._user_locks[user_id] = threading.RLock()
+            return lock
+
     def _load_index(self, user_id: str):
-        """Load or create an index for a specific user."""
-        if user_id in self.indexes:
-            return self.indexes[user_id]
+        """
+        Load or create an index for a specific user, replaying its write-ahead log.
+        Callers must hold the user's lock; only cache bookkeeping takes the store lock.
+        """
+        with self._lock:
+            if user_id in self.indexes:
+                self.indexes.move_to_end(user_id)
+                return self.indexes[user_id]
+
+        self._load_snapshot(user_id)
+        self._replay_wal(user_id)
+        self._evict_indexes(keep=user_id)
+        return self.indexes[user_id]
+
+    def _evict_indexes(self, keep: Optional[str] = None):
+        """
+        Unload least recently used indexes beyond max_loaded_users.
+        Indexes another thread is using, and indexes with uploads that are only in the WAL, are skipped:
+        the caller shouldn't pay for (or fail on) another user's checkpoint. checkpoint_all writes
+        those and evicts again.
+        """
+        while True:
+            with self._lock:
+                if len(self.indexes) <= self.max_loaded_users:
+                    return
+                victim = next((
+                    user_id for user_id in self.indexes
+                    if user_id != keep and user_id not in self._dirty_users
+                    and self._user_lock(user_id).acquire(blocking=False)
+                ), None)
+            if victim is None:
+                return
+            try:
+                with self._lock:
+                    entry = self.indexes.pop(victim, None)
+                if entry is not None:
+                    entry[1].close()
+                    logger.info(f"Evicted index for user {victim} from memory.")
+            finally:
+                self._user_locks[victim].release()
+
+    def _load_snapshot(self, user_id: str):
+        """Load the last saved index for a user, or create an empty one."""
+        return self._install_snapshot(user_id, self._read_snapshot(user_id))
 
+    def _read_snapshot(self, user_id: str) -> Optional[Tuple[faiss.Index, DocumentStore, bool]]:
+        """
+        Read a user's saved index and document store from disk without touching shared state.
+        Returns (index, documents, rebuilt), or None if there is no usable snapshot.
+        """
         user_index_path = self._get_user_index_path(user_id)
         index_file = os.path.join(user_index_path, "faiss.index")
-        docs_file = os.path.join(user_index_path, "documents.pkl")
 
-        if os.path.exists(index_file) and os.path.exists(docs_file):
-            try:
-                logger.info(f"Loading existing index for user {user_id}...")
-                index = faiss.read_index(index_file)
-                with open(docs_file, "rb") as f:
-                    documents = pickle.load(f)
-                logger.info(f"Loaded existing index for user {user_id} with {len(documents)} documents")
-                self.indexes[user_id] = (index, documents)
-                return index, documents
-            except Exception as e:
-                logger.error(f"Failed to load existing index for user {user_id}: {str(e)}", exc_info=True)
-                # If loading fails, create a new one
-                return self._create_index(user_id)
-        else:
+        if not (os.path.exists(index_file) and DocumentStore.exists(user_index_path)):
             logger.info(f"No existing index found for user {user_id}. Creating a new one.")
+            return None
+        try:
+            logger.info(f"Loading existing index for user {user_id}...")
+            index = faiss.read_index(index_file)
+            if isinstance(index, faiss.IndexHNSW):
+                index.hnsw.efSearch = self.hnsw_ef_search
+            rebuilt = index.metric_type != faiss.METRIC_INNER_PRODUCT
+            if rebuilt:
+                index = self._migrate_to_inner_product(user_id, index)
+            documents = DocumentStore.load(user_index_path)
+            if index.ntotal != len(documents):
+                index = self._reconcile_snapshot(user_id, index, documents)
+                rebuilt = True
+            logger.info(f"Loaded existing index for user {user_id} with {len(documents)} documents")
+            return index, documents, rebuilt
+        except Exception as e:
+            logger.error(f"Failed to load existing index for user {user_id}: {str(e)}", exc_info=True)
+            # If loading fails, a new one is created
+            return None
+
+    def _install_snapshot(self, user_id: str, snapshot: Optional[Tuple[faiss.Index, DocumentStore, bool]]):
+        """Cache a snapshot returned by _read_snapshot, or create an empty index if there was none."""
+        if snapshot is None:
             return self._create_index(user_id)
+        index, documents, rebuilt = snapshot
+        with self._lock:
+            self.indexes[user_id] = (index, documents)
+        if rebuilt:
+            index = self._maybe_upgrade_index(user_id, index, documents)
+            with self._lock:
+                self._dirty_users.add(user_id)
+        return index, documents
+
+    def warm_all_users(self) -> int:
+        """
+        Load the indexes of users with data on disk, several users at a time.
+        At most max_loaded_users are loaded. Returns the number of indexes loaded.
+        """
+        with self._lock:
+            user_ids = [
+                name for name in sorted(os.listdir(self.base_path))
+                if os.path.isdir(os.path.join(self.base_path, name)) and name not in self.indexes
+            ][:max(self.max_loaded_users - len(self.indexes), 0)]
+        if not user_ids:
+            return 0
+        
+        # Each user is loaded under their own lock, exactly as a request would load it, so requests
+        # only wait if they need a user that is being loaded right now. Loading may also migrate
+        # legacy files on disk (documents.pkl, L2 indexes), which the user lock keeps exclusive
+        with ThreadPoolExecutor(max_workers=self.warm_workers) as executor:
+            list(executor.map(self.preload, user_ids))
+        logger.info(f"Warmed indexes for {len(user_ids)} users.")
+        return len(user_ids)
 
-    def _create_index(self, user_id: str) -> Tuple[faiss.Index, List]:
+    def _create_index(self, user_id: str) -> Tuple[faiss.Index, DocumentStore]:
         """Create a new FAISS index for a user."""
         user_index_path = self._get_user_index_path(user_id)
         os.makedirs(user_index_path, exist_ok=True)
         
         logger.info(f"Creating new FAISS index for user {user_id}.")
-        index = faiss.IndexFlatL2(self.dimension)
-        documents = []
-        self.indexes[user_id] = (index, documents)
+        # Vectors are L2-normalized, so inner product is cosine similarity
+        index = faiss.IndexFlatIP(self.dimension)
+        documents = DocumentStore(user_index_path)
+        with self._lock:
+            self.indexes[user_id] = (index, documents)
         return index, documents
 
+    def _migrate_to_inner_product(self, user_id: str, index: faiss.Index) -> faiss.Index:
+        """Rebuild an index saved with the old L2 metric as a flat inner-product index over normalized vectors."""
+        logger.info(f"Migrating index for user {user_id} from L2 distance to inner product.")
+        flat_index = faiss.IndexFlatIP(self.dimension)
+        if index.ntotal:
+            vectors = index.reconstruct_n(0, index.ntotal)
+            faiss.normalize_L2(vectors)
+            flat_index.add(vectors)
+        return flat_index
+
+    def _reconcile_snapshot(self, user_id: str, index: faiss.Index, documents: DocumentStore) -> faiss.Index:
+        """
+        Trim an index and document store saved at different points (a crash mid-checkpoint)
+        back to the vectors and chunks they have in common. The write-ahead log restores the rest.
+        """
+        count = min(index.ntotal, len(documents))
+        logger.warning(
+            f"Index for user {user_id} holds {index.ntotal} vectors but {len(documents)} documents; "
+            f"trimming both to {count} before replaying the WAL."
+        )
+        documents.truncate(count)
+        if index.ntotal == count:
+            return index
+        flat_index = faiss.IndexFlatIP(self.dimension)
+        if count:
+            flat_index.add(index.reconstruct_n(0, count))
+        return flat_index
+
+    def _maybe_upgrade_index(self, user_id: str, index: faiss.Index, documents: DocumentStore) -> faiss.Index:
+        """
+        Rebuild a user's flat index as an HNSW graph once it grows past hnsw_threshold vectors.
+        Brute-force search is exact and cheap for small indexes, but scales linearly with their size.
+        The flat index doubles as the training set for the 8-bit scalar quantizer.
+        """
+        if not isinstance(index, faiss.IndexFlat) or index.ntotal < self.hnsw_threshold:
+            return index
+        
+        vectors = index.reconstruct_n(0, index.ntotal)
+        if self.hnsw_scalar_quantizer:
+            logger.info(f"Upgrading index for user {user_id} to HNSW with 8-bit scalar quantization and {index.ntotal} vectors.")
+            hnsw_index = faiss.IndexHNSWSQ(self.dimension, faiss.ScalarQuantizer.QT_8bit, self.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+            hnsw_index.train(vectors)
+        else:
+            logger.info(f"Upgrading index for user {user_id} to HNSW with {index.ntotal} vectors.")
+            hnsw_index = faiss.IndexHNSWFlat(self.dimension, self.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        hnsw_index.hnsw.efConstruction = self.hnsw_ef_construction
+        hnsw_index.hnsw.efSearch = self.hnsw_ef_search
+        hnsw_index.add(vectors)
+        with self._lock:
+            self.indexes[user_id] = (hnsw_index, documents)
+        return hnsw_index
+
+    def _apply_documents(self, user_id: str, embedding_matrix: np.ndarray, chunks: List[str], metadata: Dict[str, Any]):
+        """Add embeddings and their chunks to a loaded user index."""
+        index, documents = self.indexes[user_id]
+        if not embedding_matrix.flags.writeable:
+            embedding_matrix = embedding_matrix.copy()
+        faiss.normalize_L2(embedding_matrix)
+        index.add(embedding_matrix)
+        self._maybe_upgrade_index(user_id, index, documents)
+        documents.extend(chunks, metadata)
+
+    def _append_wal(self, user_id: str, start: int, embedding_matrix: np.ndarray, chunks: List[str], metadata: Dict[str, Any]) -> int:
+        """
+        Append one upload to the user's write-ahead log with a single write and fsync.
+        Returns the size of the log afterwards.
+        """
+        payload = json.dumps({"chunks": chunks, "metadata": metadata}, ensure_ascii=False, default=str).encode("utf-8")
+        rows, dim = embedding_matrix.shape
+        record = _WAL_HEADER.pack(start, rows, dim, len(payload)) + embedding_matrix.tobytes() + payload
+        
+        fd = os.open(self._get_wal_path(user_id), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, record)
+            os.fsync(fd)
+            return os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _decode_wal_payload(payload: bytes) -> Tuple[List[str], Dict[str, Any]]:
+        """Decode a WAL record's JSON payload into its chunks and metadata."""
+        record = json.loads(payload)
+        return record["chunks"], record["metadata"]
+
+    def _replay_wal(self, user_id: str):
+        """Apply write-ahead log records that are newer than the loaded snapshot."""
+        wal_path = self._get_wal_path(user_id)
+        if not os.path.exists(wal_path):
+            return
+        
+        with open(wal_path, "rb") as f:
+            wal = f.read()
+        
+        offset = replayed = 0
+        gap_start = None
+        while offset + _WAL_HEADER.size <= len(wal):
+            start, rows, dim, payload_len = _WAL_HEADER.unpack_from(wal, offset)
+            body_start = offset + _WAL_HEADER.size
+            payload_start = body_start + rows * dim * 4
+            end = payload_start + payload_len
+            if end > len(wal):
+                break
+            # The upgrade to HNSW replaces the index, so look it up for every record
+            ntotal = self.indexes[user_id][0].ntotal
+            if start > ntotal:
+                gap_start = start
+                break
+            # Records already included in the snapshot are skipped
+            if start == ntotal:
+                embedding_matrix = np.frombuffer(wal, dtype=np.float32, count=rows * dim, offset=body_start).reshape(rows, dim)
+                chunks, metadata = self._decode_wal_payload(wal[payload_start:end])
+                self._apply_documents(user_id, embedding_matrix, chunks, metadata)
+                replayed += 1
+            offset = end
+        
+        if gap_start is not None:
+            # The snapshot is missing uploads the log builds on (e.g. it failed to load). Keep the
+            # log for recovery, but move it aside so new uploads don't get appended behind the gap
+            kept_path = f"{wal_path}.{int(time.time())}.unreplayed"
+            os.replace(wal_path, kept_path)
+            logger.error(
+                f"WAL for user {user_id} continues from document {gap_start} but the index only holds "
+                f"{ntotal}; stopped replaying and kept the log at {kept_path}."
+            )
+        elif offset < len(wal):
+            # A torn write from a crash mid-append; drop it so later appends stay readable
+            logger.warning(f"Discarding {len(wal) - offset} unreadable bytes at the end of the WAL for user {user_id}.")
+            os.truncate(wal_path, offset)
+        if replayed:
+            logger.info(f"Replayed {replayed} WAL records for user {user_id}.")
+            with self._lock:
+                self._dirty_users.add(user_id)
+
+    def checkpoint(self, user_id: str):
+        """Write a user's full index snapshot and reset their write-ahead log."""
+        with self._user_lock(user_id):
+            if user_id not in self.indexes:
+                return
+            self._save_index(user_id)
+            wal_path = self._get_wal_path(user_id)
+            if os.path.exists(wal_path):
+                os.truncate(wal_path, 0)
+            with self._lock:
+                self._dirty_users.discard(user_id)
+
+    def checkpoint_all(self):
+        """Checkpoint every user with uploads that are only recorded in the write-ahead log."""
+        with self._lock:
+            dirty_users = list(self._dirty_users)
+        for user_id in dirty_users:
+            self.checkpoint(user_id)
+        self._evict_indexes()
+
     def _save_index(self, user_id: str):
-        """Save FAISS index and document metadata for a user."""
+        """Save FAISS index and document store for a user."""
         if user_id not in self.indexes:
             logger.warning(f"Attempted to save index for user {user_id}, but it's not loaded.")
             return
@@ -67,9 +356,14 @@ class FAISSVectorStore:
             user_index_path = self._get_user_index_path(user_id)
             
             if index is not None:
-                faiss.write_index(index, os.path.join(user_index_path, "faiss.index"))
-                with open(os.path.join(user_index_path, "documents.pkl"), "wb") as f:
-                    pickle.dump(documents, f)
+                # Write to temporary files first so a crash never leaves a half-written snapshot, and
+                # make the snapshot durable before checkpoint empties the WAL
+                index_file = os.path.join(user_index_path, "faiss.index")
+                faiss.write_index(index, index_file + ".tmp")
+                fsync_path(index_file + ".tmp")
+                documents.save()
+                os.replace(index_file + ".tmp", index_file)
+                fsync_path(user_index_path)
                 logger.info(f"Index for user {user_id} saved with {len(documents)} documents")
         except Exception as e:
             logger.error(f"Failed to save index for user {user_id}: {str(e)}", exc_info=True)
@@ -78,87 +372,210 @@ class FAISSVectorStore:
     def add_documents(self, user_id: str, processed_data: Dict[str, Any]) -> bool:
         """Add processed document data to a user's vector store."""
         logger.info(f"Adding {processed_data['total_chunks']} new chunks to the vector store for user {user_id}.")
+        with self._user_lock(user_id):
+            try:
+                index, documents = self._load_index(user_id)
+                
+                embeddings = processed_data["embeddings"]
+                chunks = processed_data["chunks"]
+                metadata = processed_data["metadata"]
+                
+                # Embeddings normally arrive as a float32 matrix already, in which case this is free
+                embedding_matrix = np.asarray(embeddings, dtype=np.float32)
+                
+                # Log the upload instead of rewriting the whole index, and log it before applying it
+                # so nothing is held in memory that a restart can't restore
+                wal_path = self._get_wal_path(user_id)
+                previous_wal_size = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+                try:
+                    wal_size = self._append_wal(user_id, index.ntotal, embedding_matrix, chunks, metadata)
+                    self._apply_documents(user_id, embedding_matrix, chunks, metadata)
+                except Exception:
+                    self._discard_upload(user_id, previous_wal_size)
+                    raise
+                with self._lock:
+                    self._dirty_users.add(user_id)
+                self._generations[user_id] = self._generations.get(user_id, 0) + 1
+                if wal_size >= self.wal_max_bytes:
+                    self.checkpoint(user_id)
+                
+                logger.info(f"Documents added successfully for user {user_id}.")
+                return True
+            except Exception as e:
+                logger.error(f"Failed to add documents for user {user_id}: {str(e)}", exc_info=True)
+                raise Exception(f"Failed to add documents for user {user_id}: {str(e)}")
+
+    def _discard_upload(self, user_id: str, wal_size: int):
+        """
+        Undo a failed upload: cut the WAL back to its size before the upload and unload the
+        possibly half-updated index, so the next access reloads it from disk.
+        """
+        wal_path = self._get_wal_path(user_id)
         try:
+            if os.path.exists(wal_path):
+                os.truncate(wal_path, wal_size)
+        except OSError as e:
+            logger.error(f"Failed to roll back the WAL for user {user_id}: {str(e)}", exc_info=True)
+        with self._lock:
+            entry = self.indexes.pop(user_id, None)
+        if entry is not None:
+            entry[1].close()
+
+    def search(self, user_id: str, query_embedding: np.ndarray, k: int = 5) -> List[Dict[str, Any]]:
+        """Search for similar documents in a user's index."""
+        return self.search_batch(user_id, np.asarray(query_embedding, dtype=np.float32).reshape(1, -1), k)[0]
+
+    def search_batch(self, user_id: str, query_vectors: np.ndarray, k: int = 5) -> List[List[Dict[str, Any]]]:
+        """Search a user's index for several query vectors with a single FAISS call."""
+        with self._user_lock(user_id):
             index, documents = self._load_index(user_id)
             
-            embeddings = processed_data["embeddings"]
-            chunks = processed_data["chunks"]
-            metadata = processed_data["metadata"]
-            
-            embedding_matrix = np.array(embeddings, dtype=np.float32)
-            index.add(embedding_matrix)
-            
-            for i, chunk in enumerate(chunks):
-                doc_data = {
-                    "chunk": chunk,
-                    "metadata": metadata,
-                    "chunk_index": i,
-                    "doc_id": len(documents)
-                }
-                documents.append(doc_data)
+            if index is None or len(documents) == 0:
+                logger.warning(f"Search attempted on an empty vector store for user {user_id}.")
+                return [[] for _ in range(len(query_vectors))]
             
-            self._save_index(user_id)
-            
-            logger.info(f"Documents added successfully for user {user_id}.")
-            return True
-        except Exception as e:
-            logger.error(f"Failed to add documents for user {user_id}: {str(e)}", exc_info=True)
-            raise Exception(f"Failed to add documents for user {user_id}: {str(e)}")
+            logger.info(f"Searching for {k} nearest neighbors of {len(query_vectors)} queries for user {user_id}.")
+            try:
+                k = min(k, len(documents))
+                
+                # Normalize a copy so callers' query embeddings are left untouched
+                query_vectors = np.array(query_vectors, dtype=np.float32)
+                faiss.normalize_L2(query_vectors)
+                scores, indices = index.search(query_vectors, k)
+                
+                batch_results = []
+                for row_scores, row_indices in zip(scores, indices):
+                    results = []
+                    for score, idx in zip(row_scores, row_indices):
+                        if idx != -1 and idx < len(documents):
+                            doc = documents[idx]
+                            # Cosine similarity: higher is more similar
+                            doc["similarity_score"] = float(score)
+                            results.append(doc)
+                    batch_results.append(results)
+                
+                logger.info(f"Found {sum(len(results) for results in batch_results)} matching documents for user {user_id}.")
+                return batch_results
+            except Exception as e:
+                logger.error(f"Failed to search for user {user_id}: {str(e)}", exc_info=True)
+                raise Exception(f"Failed to search for user {user_id}: {str(e)}")
 
-    def search(self, user_id: str, query_embedding: List[float], k: int = 5) -> List[Dict[str, Any]]:
-        """Search for similar documents in a user's index."""
-        index, documents = self._load_index(user_id)
-        
-        if index is None or len(documents) == 0:
-            logger.warning(f"Search attempted on an empty vector store for user {user_id}.")
-            return []
-        
-        logger.info(f"Searching for {k} nearest neighbors for user {user_id}.")
+    async def search_async(self, user_id: str, query_embedding: np.ndarray, k: int = 5) -> List[Dict[str, Any]]:
+        """
+        Search a user's index without blocking the event loop.
+        Queries arriving for the same user within search_batch_window are answered by one batched search.
+        """
+        future = asyncio.get_running_loop().create_future()
+        queue = self._search_queues.get(user_id)
+        if queue is None:
+            queue = self._search_queues[user_id] = asyncio.Queue()
+            task = asyncio.create_task(self._run_search_batches(user_id, queue))
+            self._search_tasks.add(task)
+            task.add_done_callback(self._search_tasks.discard)
+        queue.put_nowait((np.asarray(query_embedding, dtype=np.float32), k, future))
+        return await future
+
+    async def _run_search_batches(self, user_id: str, queue: asyncio.Queue):
+        """Drain a user's search queue in batches; exits once the queue is empty."""
+        loop = asyncio.get_running_loop()
+        batch = []
         try:
-            query_vector = np.array([query_embedding], dtype=np.float32)
-            k = min(k, len(documents))
-            
-            distances, indices = index.search(query_vector, k)
-            
-            results = []
-            for i, idx in enumerate(indices[0]):
-                if idx != -1 and idx < len(documents):
-                    doc = documents[idx].copy()
-                    doc["similarity_score"] = float(distances[0][i])
-                    results.append(doc)
-            
-            logger.info(f"Found {len(results)} matching documents for user {user_id}.")
-            return results
-        except Exception as e:
-            logger.error(f"Failed to search for user {user_id}: {str(e)}", exc_info=True)
-            raise Exception(f"Failed to search for user {user_id}: {str(e)}")
+            while not queue.empty():
+                batch = [queue.get_nowait()]
+                deadline = loop.time() + self.search_batch_window
+                while len(batch) < self.search_batch_max_size:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(queue.get(), remaining))
+                    except asyncio.TimeoutError:
+                        break
+                
+                try:
+                    query_vectors = np.vstack([query_vector for query_vector, _, _ in batch])
+                    max_k = max(k for _, k, _ in batch)
+                    batch_results = await asyncio.to_thread(self.search_batch, user_id, query_vectors, max_k)
+                except Exception as e:
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for (_, k, future), results in zip(batch, batch_results):
+                    if not future.done():
+                        future.set_result(results[:k])
+        finally:
+            self._search_queues.pop(user_id, None)
+            # If this task is cancelled or fails, don't leave queued callers waiting forever
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError(f"Search for user {user_id} was aborted"))
+
+    def preload(self, user_id: str):
+        """Load a user's index into memory ahead of a search."""
+        with self._user_lock(user_id):
+            self._load_index(user_id)
+
+    def get_generation(self, user_id: str) -> int:
+        """Return a counter that changes every time a user's documents are added or cleared."""
+        return self._generations.get(user_id, 0)
 
     def get_stats(self, user_id: str) -> Dict[str, Any]:
         """Get vector store statistics for a user."""
-        index, documents = self._load_index(user_id)
-        return {
-            "user_id": user_id,
-            "total_documents": len(documents),
-            "index_size": index.ntotal if index else 0,
-            "dimension": self.dimension
-        }
+        with self._user_lock(user_id):
+            index, documents = self._load_index(user_id)
+            return {
+                "user_id": user_id,
+                "total_documents": len(documents),
+                "index_size": index.ntotal if index else 0,
+                "dimension": self.dimension
+            }
 
-    def clear_user_index(self, user_id: str) -> bool:
+    def clear(self, user_id: str) -> bool:
         """
-        Clear all documents from a user's vector database by deleting their data directory.
-        Returns True if the directory was deleted, False otherwise.
+        Clear all documents from a user's vector database in place.
+        The index is reset and the document store and WAL are truncated rather than deleting and
+        recreating the user's directory. Logs set aside by _replay_wal and leftover temporary files
+        are deleted too, so none of the user's data remains. Returns True if there was anything to clear.
         """
         user_index_path = self._get_user_index_path(user_id)
-        if user_id in self.indexes:
-            del self.indexes[user_id]
-        
-        if os.path.exists(user_index_path):
-            shutil.rmtree(user_index_path)
-            logger.info(f"Deleted user data directory for user {user_id}")
+        index_file = os.path.join(user_index_path, "faiss.index")
+        wal_path = self._get_wal_path(user_id)
+        with self._user_lock(user_id):
+            leftovers = glob.glob(glob.escape(wal_path) + ".*") + glob.glob(os.path.join(glob.escape(user_index_path), "*.tmp"))
+            with self._lock:
+                self._dirty_users.discard(user_id)
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            
+            entry = self.indexes.get(user_id)
+            had_data = (
+                (entry is not None and len(entry[1]) > 0)
+                or os.path.exists(index_file)
+                or (os.path.exists(wal_path) and os.path.getsize(wal_path) > 0)
+                or bool(leftovers)
+            )
+            if not had_data:
+                logger.info(f"No data found for user {user_id}. Nothing to clear.")
+                return False
+            
+            if entry is not None:
+                index, documents = entry
+                if isinstance(index, faiss.IndexFlat):
+                    index.reset()
+                else:
+                    # Start over with an exact flat index; it is upgraded again once it grows
+                    with self._lock:
+                        self.indexes[user_id] = (faiss.IndexFlatIP(self.dimension), documents)
+            else:
+                documents = DocumentStore(user_index_path)
+            documents.clear()
+            
+            if os.path.exists(wal_path):
+                os.truncate(wal_path, 0)
+            for path in [index_file] + leftovers:
+                if os.path.exists(path):
+                    os.remove(path)
+            logger.info(f"Cleared vector database for user {user_id}")
             return True
-        
-        logger.info(f"No data directory found for user {user_id}. Nothing to clear.")
-        return False
-
-# Initialize vector store
-vector_store = FAISSVectorStore()